@@ -1,5 +1,9 @@
 import os
+import re
+import shutil
 import tempfile
+import threading
+import time
 import streamlit as st
 from elsai_core.model import AzureOpenAIConnector
 from elsai_core.extractors.azure_document_intelligence import AzureDocumentIntelligence
@@ -11,6 +15,13 @@ from azure.ai.documentintelligence import DocumentIntelligenceClient
 
 logger = setup_logger()
 
+# Markdown code fences the LLM wraps its answers in
+_CODE_FENCE_RE = re.compile(r'```(?:markdown)?')
+
+# Seconds a fetched Pezzo prompt is reused before it is fetched again, so prompt edits
+# reach the long-lived (st.cache_resource) processor without a restart
+PROMPT_TTL_SECONDS = int(os.getenv("PEZZO_PROMPT_TTL", "300"))
+
 class DocumentProcessor:
     """
     Backend class to handle all document processing operations
@@ -20,6 +31,11 @@ class DocumentProcessor:
         """Initialize the document processor with Azure credentials"""
         self.endpoint = os.getenv("VISION_ENDPOINT")
         self.key = os.getenv("VISION_KEY")
+        # Pezzo prompts fetched so far as (prompt, fetch time), keyed by (project secret name, prompt name)
+        self._prompts = {}
+        # LLM client created on first use and shared across files (and worker threads)
+        self._llm = None
+        self._llm_lock = threading.Lock()
         
     def check_credentials(self):
         """Check if Azure credentials are available"""
@@ -329,6 +345,41 @@ class DocumentProcessor:
             logger.error(f"Processing error: {str(e)}", exc_info=True)
             return f"Error: {str(e)}"
 
+    def _get_llm(self):
+        """Return the shared Azure OpenAI client, connecting on first use"""
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    connector = AzureOpenAIConnector()
+                    self._llm = connector.connect_azure_open_ai(deploymentname="gpt-4o-mini")
+        return self._llm
+
+    def _get_prompt(self, project_id_key, prompt_name):
+        """
+        Get a Pezzo prompt, fetching it again only once PROMPT_TTL_SECONDS have passed.
+        
+        Args:
+            project_id_key (str): Name of the secret holding the Pezzo project ID
+            prompt_name (str): The Pezzo prompt name
+            
+        Returns:
+            str: The prompt text
+        """
+        cache_key = (project_id_key, prompt_name)
+        cached = self._prompts.get(cache_key)
+        if cached is not None and time.monotonic() - cached[1] < PROMPT_TTL_SECONDS:
+            return cached[0]
+        renderer = PezzoPromptRenderer(
+            api_key=st.secrets["PEZZO_API_KEY"],
+            project_id=st.secrets[project_id_key],
+            environment=st.secrets["PEZZO_ENVIRONMENT"],
+            server_url=st.secrets["PEZZO_SERVER_URL"]
+        )
+        prompt = renderer.get_prompt(prompt_name)
+        self._prompts[cache_key] = (prompt, time.monotonic())
+        logger.debug(f"Fetched prompt from Pezzo: {prompt_name}")
+        return prompt
+
     def _get_prompt_name_by_type(self, document_type):
         """
         Get the appropriate Pezzo prompt name based on document type.
@@ -369,7 +420,9 @@ class DocumentProcessor:
         
         # Create a temporary file
         with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
+            # Stream in 1 MiB chunks instead of materializing the whole upload as bytes
+            uploaded_file.seek(0)
+            shutil.copyfileobj(uploaded_file, tmp_file, length=1024 * 1024)
             tmp_path = tmp_file.name
             logger.debug(f"Created temporary file: {tmp_path}")
         
@@ -383,29 +436,15 @@ class DocumentProcessor:
             markdown_content = self._convert_to_markdown(text_content, tables)
             logger.debug("Markdown conversion completed")
             
-            # Initialize Azure OpenAI connector
-            logger.info("Initializing LLM connector")
-            connector = AzureOpenAIConnector()
-            llm = connector.connect_azure_open_ai(deploymentname="gpt-4o-mini")
-            logger.info("LLM connector initialized")
-            
-            # Initialize Pezzo prompt renderer
-            logger.info("Initializing Pezzo prompt renderer")
-            renderer = PezzoPromptRenderer(
-                api_key=st.secrets["PEZZO_API_KEY"],
-                project_id=st.secrets["PEZZO_PROJECT_ID_2"],
-                environment=st.secrets["PEZZO_ENVIRONMENT"],
-                server_url=st.secrets["PEZZO_SERVER_URL"]
-            )
-            logger.info("Pezzo prompt renderer initialized")
+            # Get the shared Azure OpenAI client
+            llm = self._get_llm()
             
             # Get appropriate prompt name based on document type
             prompt_name = self._get_prompt_name_by_type(document_type)
             logger.info(f"Using Pezzo prompt: {prompt_name}")
             
-            # Get prompt from Pezzo
-            prompt = renderer.get_prompt(prompt_name)
-            logger.debug(f"Retrieved prompt from Pezzo: {prompt_name}")
+            # Get prompt from Pezzo (cached after the first file)
+            prompt = self._get_prompt("PEZZO_PROJECT_ID_2", prompt_name)
             
             # Format the prompt with document content
             prompt_txt = f"{prompt}\n\nDocument Content: {markdown_content}"
@@ -413,7 +452,7 @@ class DocumentProcessor:
             # Send to LLM
             logger.info("Sending request to LLM")
             response = llm.invoke(prompt_txt)
-            result = response.content
+            result = _CODE_FENCE_RE.sub('', response.content)
             logger.info(f"Received response from LLM ({len(result)} characters)")
             
             return result
@@ -431,17 +470,8 @@ class DocumentProcessor:
     def generate_comparison_summary(self, invoice_content, po_content):
         """Generate a comparison summary between invoice and PO content"""
         try:
-            connector = AzureOpenAIConnector()
-            llm = connector.connect_azure_open_ai(deploymentname="gpt-4o-mini")
-            renderer = PezzoPromptRenderer(
-                api_key=st.secrets["PEZZO_API_KEY"],
-                project_id=st.secrets["PEZZO_PROJECT_ID"],
-                environment=st.secrets["PEZZO_ENVIRONMENT"],
-                server_url=st.secrets["PEZZO_SERVER_URL"]
-            )
-     
-            prompt_name = "PurchaseOrder"
-            prompt = renderer.get_prompt(prompt_name)
+            llm = self._get_llm()
+            prompt = self._get_prompt("PEZZO_PROJECT_ID", "PurchaseOrder")
      
             prompt_txt = f"{prompt}\n\nText: {invoice_content},{po_content}"
             response = llm.invoke(prompt_txt)
@@ -469,21 +499,14 @@ class DocumentProcessor:
             tables_str = self._format_table(tables)
             
             # Process with LLM
-            connector = AzureOpenAIConnector()
-            llm = connector.connect_azure_open_ai(deploymentname="gpt-4o-mini")
+            llm = self._get_llm()
                
             # Generate prompt for LLM
-            renderer = PezzoPromptRenderer(
-                api_key=st.secrets["PEZZO_API_KEY"],
-                project_id=st.secrets["PEZZO_PROJECT_ID_1"],
-                environment=st.secrets["PEZZO_ENVIRONMENT"],
-                server_url=st.secrets["PEZZO_SERVER_URL"]
-            )
-            prompt = renderer.get_prompt("InvoiceParsingPrompt") 
+            prompt = self._get_prompt("PEZZO_PROJECT_ID_1", "InvoiceParsingPrompt")
             prompt_txt = prompt + f"""The content is as follows: Text from the document : {text_content} , Tables from the document : {tables_str}"""
             
             response = llm.invoke(prompt_txt)
-            result = response.content
+            result = _CODE_FENCE_RE.sub('', response.content)
             
             return result
             
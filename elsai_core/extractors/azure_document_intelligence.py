@@ -1,22 +1,28 @@
 import os
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 from elsai_core.config.loggerConfig import setup_logger
 class AzureDocumentIntelligence:
     """
     Class to handle document analysis using Azure Document Intelligence.
     """
 
-    def __init__(self, file_path:str):
+    def __init__(self, file_path:str, key: str = None, endpoint: str = None, session=None):
         self.logger = setup_logger()
-        # Set up API key and endpoint
-        self.key = os.environ["VISION_KEY"]
-        self.endpoint = os.environ["VISION_ENDPOINT"]
+        # Set up API key and endpoint (fall back to the environment when not passed)
+        self.key = key or os.environ["VISION_KEY"]
+        self.endpoint = endpoint or os.environ["VISION_ENDPOINT"]
         self.file_path = file_path
+        # Reuse the caller's requests.Session (and its keep-alive pool) when one is given
+        client_kwargs = {}
+        if session is not None:
+            client_kwargs['transport'] = RequestsTransport(session=session, session_owner=False)
         # Initialize the Document Intelligence Client
         self.client = DocumentIntelligenceClient(
             endpoint=self.endpoint,
-            credential=AzureKeyCredential(self.key)
+            credential=AzureKeyCredential(self.key),
+            **client_kwargs
         )
 
     def extract_text(self, pages: str = None) -> str:
@@ -14,6 +14,8 @@ class AzureOpenAIConnector:
         self.azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT", None)  
         self.openai_api_version = os.getenv("OPENAI_API_VERSION", None)
         self.temperature = float(os.getenv("AZURE_OPENAI_TEMPERATURE", 0.1))
+        # Retries (with exponential backoff) for rate-limited/transient errors such as HTTP 429
+        self.max_retries = int(os.getenv("AZURE_OPENAI_MAX_RETRIES", 6))
 
     def connect_azure_open_ai(self, deploymentname: str):
         """
@@ -48,7 +50,8 @@ class AzureOpenAIConnector:
                     openai_api_key=self.openai_api_key,
                     azure_endpoint=self.azure_endpoint,  
                     openai_api_version=self.openai_api_version,
-                    temperature=self.temperature
+                    temperature=self.temperature,
+                    max_retries=self.max_retries
                 )
             self.logger.info(f"Successfully connected to Azure OpenAI model: {llm}")
             return llm
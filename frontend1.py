@@ -1,22 +1,33 @@
 import os
+import shutil
 import tempfile
 import streamlit as st
 import pandas as pd
-from io import StringIO
+from io import StringIO, BytesIO
 import zipfile
+import csv
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from backend import DocumentProcessor
+from backend import DocumentProcessor, PROMPT_TTL_SECONDS
 
 # Load environment variables
 load_dotenv()
 
 # Import the backend processor for zip processing
 try:
-    from invoice_processor import create_processor, InvoiceProcessor
+    from invoice_processor import create_processor, InvoiceProcessor, VALID_EXT
     ZIP_PROCESSOR_AVAILABLE = True
 except ImportError:
     ZIP_PROCESSOR_AVAILABLE = False
+    VALID_EXT = ('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')
+
+# polars parses the results CSV faster than pandas; fall back to pandas when it isn't installed
+try:
+    import polars as pl
+    POLARS_AVAILABLE = True
+except ImportError:
+    POLARS_AVAILABLE = False
 
 st.set_page_config(page_title="Document Intelligence", page_icon="📄", layout="wide")
 
@@ -61,6 +72,11 @@ if 'processing_complete' not in st.session_state:
     st.session_state.processing_complete = False
 if 'csv_content' not in st.session_state:
     st.session_state.csv_content = None
+if 'csv_total_rows' not in st.session_state:
+    st.session_state.csv_total_rows = None
+
+# Only this many rows are parsed for the on-screen preview; the download has everything
+PREVIEW_ROWS = 1000
 
 # Initialize the document processor
 @st.cache_resource
@@ -69,6 +85,32 @@ def get_document_processor():
 
 processor = get_document_processor()
 
+# Credentials, HTTP session, Pezzo prompts and the LLM client are shared by ZIP runs
+# instead of being rebuilt per upload; the TTL rebuilds the processor so Pezzo prompt
+# edits (and the response-cache keys derived from them) are picked up without a restart
+@st.cache_resource(ttl=PROMPT_TTL_SECONDS)
+def get_zip_processor():
+    return create_processor()
+
+# Keyed on the uploaded bytes, so reruns with the same file skip the Azure round-trip.
+# Errors are raised rather than returned so they are never cached.
+@st.cache_data(show_spinner=False)
+def _extract_cached(file_bytes, file_ext, document_type):
+    with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as temp_file:
+        temp_file.write(file_bytes)
+        temp_path = temp_file.name
+    result = processor.process_file(temp_path, document_type)
+    if isinstance(result, str) and result.startswith("Error: "):
+        raise RuntimeError(result[len("Error: "):])
+    return result, temp_path
+
+@st.cache_data(show_spinner=False)
+def _compare_cached(invoice_content, po_content):
+    comparison = processor.generate_comparison_summary(invoice_content, po_content)
+    if comparison.startswith("Error generating comparison:"):
+        raise RuntimeError(comparison)
+    return comparison
+
 def process_uploaded_file(uploaded_file, document_type):
     st.write(f"Processing {document_type}: {uploaded_file.name}")
     progress = st.progress(0)
@@ -77,16 +119,12 @@ def process_uploaded_file(uploaded_file, document_type):
     
     # Get file extension
     file_extension = os.path.splitext(uploaded_file.name)[1].lower()
-    
-    # Create temp file with appropriate extension
-    with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-        temp_file.write(uploaded_file.getvalue())
-        temp_path = temp_file.name
+    temp_path = None
  
     try:
         progress.progress(20)
         status.text("Extracting data...")
-        result = processor.process_file(temp_path, document_type)
+        result, temp_path = _extract_cached(uploaded_file.getvalue(), file_extension, document_type)
    
         progress.progress(100)
         status.text("Done ✅")
@@ -115,12 +153,16 @@ def validate_zip_file(uploaded_file):
     if not uploaded_file.name.lower().endswith('.zip'):
         return False, "Please upload a ZIP file"
     
+    return _validate_zip_bytes(uploaded_file.getvalue())
+
+@st.cache_data(show_spinner=False)
+def _validate_zip_bytes(file_bytes):
+    """Check the ZIP contents once per distinct upload"""
     # Check if zip file contains valid documents
     try:
-        with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:
-            file_list = zip_ref.namelist()
-            valid_extensions = ('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')
-            valid_files = [f for f in file_list if f.lower().endswith(valid_extensions)]
+        with zipfile.ZipFile(BytesIO(file_bytes), 'r') as zip_ref:
+            valid_files = [info.filename for info in zip_ref.infolist()
+                           if not info.is_dir() and info.filename.lower().endswith(VALID_EXT)]
             
             if not valid_files:
                 return False, "ZIP file must contain at least one document file (PDF, PNG, JPG, JPEG, TIFF, BMP)"
@@ -140,15 +182,17 @@ def process_zip_invoices(uploaded_file):
         status_text.text("Initializing processor...")
         progress_bar.progress(10)
         
-        # Create processor instance
-        zip_processor = create_processor()
+        # Get the shared processor instance
+        zip_processor = get_zip_processor()
         
         status_text.text("Saving uploaded file...")
         progress_bar.progress(20)
         
         # Save uploaded file temporarily
         with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
+            # Stream in 1 MiB chunks instead of materializing the whole upload as bytes
+            uploaded_file.seek(0)
+            shutil.copyfileobj(uploaded_file, tmp_file, length=1024 * 1024)
             tmp_file_path = tmp_file.name
         
         status_text.text("Processing invoices...")
@@ -163,8 +207,10 @@ def process_zip_invoices(uploaded_file):
         # Clean up temporary file
         os.unlink(tmp_file_path)
         
-        # Store results in session state
+        # Store results in session state (count rows once here rather than on every rerun;
+        # csv.reader keeps quoted multi-line addresses as a single record)
         st.session_state.csv_content = csv_content
+        st.session_state.csv_total_rows = sum(1 for _ in csv.reader(StringIO(csv_content))) - 1
         st.session_state.processing_complete = True
         
         progress_bar.progress(100)
@@ -181,23 +227,34 @@ def process_zip_invoices(uploaded_file):
             except:
                 pass
 
+def read_csv_preview(csv_content):
+    """Parse the first PREVIEW_ROWS rows of the results CSV into a pandas DataFrame"""
+    if POLARS_AVAILABLE:
+        # Read every column as text: extracted fields mix numbers with "N/A"
+        df = pl.read_csv(StringIO(csv_content), n_rows=PREVIEW_ROWS, infer_schema_length=0)
+        return df.to_pandas()
+    return pd.read_csv(StringIO(csv_content), nrows=PREVIEW_ROWS)
+
 def display_zip_results():
     """Display ZIP processing results"""
     st.header("📊 Processing Results")
     
     # Parse CSV content for preview
     try:
-        df = pd.read_csv(StringIO(st.session_state.csv_content))
+        df = read_csv_preview(st.session_state.csv_content)
+        total_rows = st.session_state.csv_total_rows
         
         col1, col2 = st.columns([3, 1])
         
         with col1:
             st.subheader("📋 Data Preview")
             st.dataframe(df, use_container_width=True, height=400)
+            if total_rows > len(df):
+                st.caption(f"Showing the first {len(df)} of {total_rows} records. Download the CSV for the full results.")
         
         with col2:
             st.subheader("📈 Summary")
-            st.metric("Total Records", len(df))
+            st.metric("Total Records", total_rows)
             st.metric("Total Columns", len(df.columns))
             
             # File download
@@ -244,46 +301,51 @@ def invoice_parser_app():
         
         # Process files when user clicks the button
         if st.button("Process Files"):
+            # Create a progress bar per file and save uploads to temporary locations
+            jobs = []
             for uploaded_file in uploaded_files:
-                # Create progress bar for this file
                 progress_bar = st.progress(0)
                 status_text = st.empty()
-                
                 status_text.text(f"Processing: {uploaded_file.name}...")
                 
-                # Save uploaded file to temporary location
                 with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-                    temp_file.write(uploaded_file.getvalue())
+                    uploaded_file.seek(0)
+                    shutil.copyfileobj(uploaded_file, temp_file, length=1024 * 1024)
                     temp_file_path = temp_file.name
                 
-                try:
-                    progress_bar.progress(25)
-                    status_text.text(f"Analyzing document: {uploaded_file.name}")
-                    
-                    # Process the PDF
-                    result = processor.process_invoice_pdf(temp_file_path).replace("```markdown","").replace("```","")
-                    
-                    progress_bar.progress(100)
-                    status_text.text(f"Completed: {uploaded_file.name}")
-                    
-                    # Display results in an expander
-                    with st.expander(f"Results for {uploaded_file.name}", expanded=True):
-                        st.markdown(result)
-                        
-                        # Add download button for the results
-                        st.download_button(
-                            label="Download results as markdown",
-                            data=result,
-                            file_name=f"{os.path.splitext(uploaded_file.name)[0]}_results.md",
-                            mime="text/markdown"
-                        )               
-                except Exception as e:
-                    progress_bar.progress(100)
-                    status_text.text(f"Error processing: {uploaded_file.name}")
-                    st.error(f"Error processing {uploaded_file.name}: {str(e)}")
-                
-                finally:
-                    # Clean up temporary file
+                progress_bar.progress(25)
+                jobs.append((uploaded_file, temp_file_path, progress_bar, status_text))
+            
+            # Azure calls run on worker threads; all st.* calls stay on this thread
+            try:
+                with ThreadPoolExecutor(max_workers=min(8, len(jobs))) as executor:
+                    futures = {executor.submit(processor.process_invoice_pdf, job[1]): job for job in jobs}
+                    for future in as_completed(futures):
+                        uploaded_file, _, progress_bar, status_text = futures[future]
+                        try:
+                            result = future.result()
+                            
+                            progress_bar.progress(100)
+                            status_text.text(f"Completed: {uploaded_file.name}")
+                            
+                            # Display results in an expander
+                            with st.expander(f"Results for {uploaded_file.name}", expanded=True):
+                                st.markdown(result)
+                                
+                                # Add download button for the results
+                                st.download_button(
+                                    label="Download results as markdown",
+                                    data=result,
+                                    file_name=f"{os.path.splitext(uploaded_file.name)[0]}_results.md",
+                                    mime="text/markdown"
+                                )               
+                        except Exception as e:
+                            progress_bar.progress(100)
+                            status_text.text(f"Error processing: {uploaded_file.name}")
+                            st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+            finally:
+                # Clean up temporary files
+                for _, temp_file_path, _, _ in jobs:
                     if os.path.exists(temp_file_path):
                         os.unlink(temp_file_path)
                 
@@ -330,10 +392,14 @@ def invoice_po_comparison_app():
     if st.session_state.invoice_path and st.session_state.po_path:
         if st.button("Compare Documents"):
             with st.spinner("Generating comparison summary..."):
-                comparison = processor.generate_comparison_summary(
-                    st.session_state.invoice_content, 
-                    st.session_state.po_content
-                )
+                try:
+                    comparison = _compare_cached(
+                        st.session_state.invoice_content, 
+                        st.session_state.po_content
+                    )
+                except Exception as e:
+                    st.error(str(e))
+                    return
                 st.markdown(comparison)
                 st.download_button(
                     "Download Comparison",
@@ -372,29 +438,35 @@ def document_parsing_app():
     if uploaded_files:
         if st.button("Process Files", key="process_advanced_files"):            
             with st.spinner("Processing files..."):
-                # Process each file
-                for uploaded_file in uploaded_files:
-                    st.subheader(f"Processing: {uploaded_file.name}")
-                    
-                    # Process the file with the selected document type
-                    result = processor.process_pdf_advanced(uploaded_file, document_type).replace("```markdown","").replace("```","")
-                    
-                    # Create a container for the rendered markdown
-                    table_container = st.container()
-                    with table_container:
-                        # Render the markdown as a table
-                        st.markdown(result, unsafe_allow_html=True)
-                    
-                    # Add download button
-                    st.download_button(
-                        label="Download results as markdown",
-                        data=result,
-                        file_name=f"{os.path.splitext(uploaded_file.name)[0]}_results.md",
-                        mime="text/markdown"
-                    )
-                    
-                    # Add a divider between files
-                    st.markdown("---")
+                # Process the files concurrently with the selected document type;
+                # results are rendered on this thread as each one finishes
+                with ThreadPoolExecutor(max_workers=min(8, len(uploaded_files))) as executor:
+                    futures = {
+                        executor.submit(processor.process_pdf_advanced, uploaded_file, document_type): uploaded_file
+                        for uploaded_file in uploaded_files
+                    }
+                    for future in as_completed(futures):
+                        uploaded_file = futures[future]
+                        st.subheader(f"Processing: {uploaded_file.name}")
+                        
+                        result = future.result()
+                        
+                        # Create a container for the rendered markdown
+                        table_container = st.container()
+                        with table_container:
+                            # Render the markdown as a table
+                            st.markdown(result, unsafe_allow_html=True)
+                        
+                        # Add download button
+                        st.download_button(
+                            label="Download results as markdown",
+                            data=result,
+                            file_name=f"{os.path.splitext(uploaded_file.name)[0]}_results.md",
+                            mime="text/markdown"
+                        )
+                        
+                        # Add a divider between files
+                        st.markdown("---")
                 
                 st.success("All files processed successfully!")
     else:
@@ -1,145 +1,102 @@
 import os
+import re
 import json
-import csv
 import zipfile
+import time
+import hashlib
+import sqlite3
 import tempfile
-from typing import List, Dict, Any
+import threading
+import zlib
+from collections import Counter
+from typing import List, Dict, Any, Tuple, Iterator, Iterable, Optional, TextIO, NamedTuple
+from itertools import chain, islice
 from io import StringIO
+import orjson
 import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
 from elsai_core.model import AzureOpenAIConnector
 from elsai_core.extractors.azure_document_intelligence import AzureDocumentIntelligence
 from elsai_core.config.loggerConfig import setup_logger
 from elsai_core.prompts import PezzoPromptRenderer
-from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import traceback
 
-def process_single_file_worker(args):
+# Document types sent to Azure Document Intelligence
+VALID_EXT = ('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')
+
+# Greedy match from the first '{' to the last '}' (also strips any ```json fences)
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+# Optional ```json fence around a whole response
+_JSON_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*(.*?)\s*```\s*$', re.DOTALL)
+
+# Fields copied from the LLM response into each CSV row
+_INVOICE_KEYS = ('invoice_number', 'invoice_date', 'customer_name', 'customer_address')
+_ITEM_KEYS = ('item_description', 'qty')
+
+# Number of rows buffered before they are encoded to CSV in one pandas call
+_CSV_CHUNK_ROWS = 10000
+
+
+class InvoiceRow(NamedTuple):
     """
-    Worker function for processing a single file - must be at module level for pickling
+    One CSV row: an invoice line item, or the whole invoice when it has no items.
+    Field order is the CSV column order.
+    """
+    source_file: str
+    invoice_number: Any = 'N/A'
+    invoice_date: Any = 'N/A'
+    customer_name: Any = 'N/A'
+    customer_address: Any = 'N/A'
+    item_description: Any = 'N/A'
+    qty: Any = 'N/A'
+    processing_error: str = 'N/A'
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class _ResponseCache:
+    """
+    SQLite-backed store of parsed LLM extractions, shared by the worker threads.
     """
-    file_path, credentials = args
-    logger = setup_logger()
-    
-    try:
-        logger.info(f"Worker processing file: {os.path.basename(file_path)}")
-        
-        # Extract content using Azure Document Intelligence
-        try:
-            logger.info(f"Extracting content from {file_path}")
-            os.environ["VISION_KEY"] = credentials['azure_key']
-            os.environ["VISION_ENDPOINT"] = credentials['azure_endpoint']
-            azure_extractor = AzureDocumentIntelligence(file_path=file_path)
-            text_content = azure_extractor.extract_text()
-            extracted_content = {
-                'text': text_content,
-                'tables': [],
-                'file_name': os.path.basename(file_path)
-            }
-        except Exception as e:
-            logger.error(f"Error extracting content from {file_path}: {str(e)}")
-            raise
-        
-        # Process with Pezzo AI to get structured data
-        try:
-            logger.info(f"Processing content with Pezzo for {extracted_content['file_name']}")
-            
-            # Initialize Pezzo renderer for this worker
-            pezzo_renderer = PezzoPromptRenderer(
-                api_key=credentials['pezzo_api_key'],
-                project_id=credentials['PEZZO_PROJECT_ID_3'],
-                environment=os.getenv('PEZZO_ENVIRONMENT', 'Production'),
-                server_url=os.getenv('PEZZO_SERVER_URL')
-            )
-            
-            # Format the content
-            document_content = f"""
-            Text from the document:
-            {extracted_content['text']}
-
-            Tables from the document:
-            {json.dumps(extracted_content['tables'], indent=2)}
-            """
-
-            # Get and render the prompt
-            prompt_template = pezzo_renderer.get_prompt("ExtractionPrompt")
-            rendered_prompt = prompt_template.format(document_content=document_content)
-
-            # Call the LLM
-            openai_connector = AzureOpenAIConnector()
-            model_deployment = os.getenv('AZURE_MODEL_DEPLOYMENT_NAME')
-            if not model_deployment:
-                raise ValueError("AZURE_MODEL_DEPLOYMENT_NAME environment variable is not set")
-            llm = openai_connector.connect_azure_open_ai(model_deployment)
-            response = llm.invoke(rendered_prompt)
-
-            response_text = response.content.strip()
-            if response_text.startswith('```json'):
-                response_text = response_text[len('```json'):].strip()
-            if response_text.endswith('```'):
-                response_text = response_text[:-len('```')].strip()
-
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            if json_start >= 0 and json_end > json_start:
-                json_str = response_text[json_start:json_end]
-                extracted_data = json.loads(json_str)
-            else:
-                raise json.JSONDecodeError("No JSON object found in response", response_text, 0)
-
-            invoice_info = {
-                'source_file': extracted_content['file_name'],
-                'invoice_number': str(extracted_data.get('invoice_number', 'N/A')),
-                'invoice_date': str(extracted_data.get('invoice_date', 'N/A')),
-                'customer_name': str(extracted_data.get('customer_name', 'N/A')),
-                'customer_address': str(extracted_data.get('customer_address', 'N/A'))
-            }
 
-            items = extracted_data.get('items', [])
-            processed_records = []
-
-            if not items:
-                record = invoice_info.copy()
-                record.update({
-                    'item_description': 'N/A',
-                    'qty': 'N/A',
-
-                })
-                processed_records.append(record)
-            else:
-                for item in items:
-                    if isinstance(item, dict):
-                        record = invoice_info.copy()
-                        record.update({
-                            'item_description': str(item.get('item_description', 'N/A')),
-                            'qty': str(item.get('qty', 'N/A')),
-
-                        })
-                        processed_records.append(record)
-            
-            logger.info(f"Successfully processed {os.path.basename(file_path)} - {len(processed_records)} records")
-            return processed_records
-            
-        except Exception as e:
-            logger.error(f"Error processing with Pezzo for {file_path}: {str(e)}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            raise
-            
-    except Exception as e:
-        logger.error(f"Error processing file {file_path}: {str(e)}")
-        logger.error(f"Full traceback: {traceback.format_exc()}")
-        
-        # Return error record to ensure file is not missed
-        fieldnames = [
-            'source_file', 'invoice_number', 'invoice_date', 'customer_name',
-            'customer_address', 'item_description', 'qty', 'processing_error'
-        ]
-        
-        error_record = {
-            'source_file': os.path.basename(file_path),
-            'processing_error': str(e),
-            **{f: 'N/A' for f in fieldnames if f not in ['source_file', 'processing_error']}
-        }
-        return [error_record]
+    def __init__(self, path: str, ttl_seconds: int):
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            # Expired rows are skipped on read; drop them here so the file does not grow forever
+            self._conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return orjson.loads(row[0])
+
+    def set(self, key: str, value: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, orjson.dumps(value), time.time() + self._ttl_seconds)
+            )
+            self._conn.commit()
 
 
 class InvoiceProcessor:
@@ -147,6 +104,9 @@ class InvoiceProcessor:
         self.logger = setup_logger()
         self.azure_endpoint = azure_endpoint
         self.azure_key = azure_key
+        # Shared HTTP session so Azure Document Intelligence calls reuse TLS connections
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
         self.pezzo_renderer = PezzoPromptRenderer(
             api_key=pezzo_api_key,
             project_id=pezzo_project_id,
@@ -154,198 +114,447 @@ class InvoiceProcessor:
             server_url=os.getenv('PEZZO_SERVER_URL')
         )
         self.openai_connector = AzureOpenAIConnector()
-        # Store credentials for worker processes
-        self._credentials = {
-            'azure_endpoint': azure_endpoint,
-            'azure_key': azure_key,
-            'pezzo_api_key': pezzo_api_key,
-            'PEZZO_PROJECT_ID_3': pezzo_project_id
-        }
-
-    def extract_zip_files(self, zip_path: str) -> List[str]:
-        extracted_files = []
-        temp_dir = tempfile.mkdtemp()
+        # The LLM client is created on first use and shared by all worker threads
+        self._model_deployment = os.getenv('AZURE_MODEL_DEPLOYMENT_NAME')
+        self._llm = None
+        self._llm_lock = threading.Lock()
+        # Fetch the extraction prompt once instead of hitting Pezzo for every file
+        self._prompt_template = self.pezzo_renderer.get_prompt("ExtractionPrompt")
+        # Tables are not extracted for ZIP invoices, so that section is always empty
+        self._doc_template = "Text from the document:\n{text}\n\nTables from the document:\n[]"
+        # Documents per LLM call (1 disables batching). Batching needs a dedicated
+        # ExtractionPromptBatch in Pezzo; without one every document gets its own call.
+        requested_batch_size = os.getenv('INVOICE_BATCH_SIZE')
+        self._batch_prompt_template = None
+        if requested_batch_size is None or int(requested_batch_size) > 1:
+            try:
+                self._batch_prompt_template = self.pezzo_renderer.get_prompt("ExtractionPromptBatch")
+            except Exception as e:
+                self.logger.warning(f"ExtractionPromptBatch unavailable ({str(e)}), batching disabled")
+        if self._batch_prompt_template:
+            self.batch_size = max(1, int(requested_batch_size or '5'))
+        else:
+            self.batch_size = 1
+        # Parsed extractions keyed by document text, so resent invoices skip the LLM.
+        # Keys include the prompt and deployment so editing either invalidates old entries.
+        self._prompt_version = hashlib.blake2b(
+            f"{self._model_deployment}\0{self._prompt_template}\0{self._batch_prompt_template}".encode(),
+            digest_size=8
+        ).hexdigest()
+        self._response_cache = None
+        cache_dir = os.getenv('INVOICE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'invoice_cache'))
+        if cache_dir:
+            try:
+                # Entries hold customer names and addresses, so keep the directory private
+                os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+                os.chmod(cache_dir, 0o700)
+                self._response_cache = _ResponseCache(
+                    os.path.join(cache_dir, 'responses.sqlite3'),
+                    ttl_seconds=int(os.getenv('INVOICE_CACHE_TTL', str(7 * 86400)))
+                )
+            except Exception as e:
+                self.logger.warning(f"Response cache disabled: {str(e)}")
+
+    def _get_llm(self):
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    if not self._model_deployment:
+                        raise ValueError("AZURE_MODEL_DEPLOYMENT_NAME environment variable is not set")
+                    self._llm = self.openai_connector.connect_azure_open_ai(self._model_deployment)
+        return self._llm
+
+    def extract_zip_files(self, zip_path: str) -> Iterator[Tuple[str, bytes]]:
+        """
+        Stream valid documents out of the ZIP one entry at a time as (file_name, bytes),
+        without extracting the archive to disk.
+        """
+        extracted_count = 0
         try:
-            self.logger.info(f"Extracting ZIP file: {zip_path}")
+            self.logger.info(f"Reading ZIP file: {zip_path}")
             with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-            for root, dirs, files in os.walk(temp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    if file.lower().endswith(('.pdf', '.png', '.jpg', '.jpeg', '.tiff', '.bmp')):
-                        extracted_files.append(file_path)
-            self.logger.info(f"Extracted {len(extracted_files)} valid document files")
+                for info in zip_ref.infolist():
+                    if info.is_dir() or not info.filename.lower().endswith(VALID_EXT):
+                        continue
+                    with zip_ref.open(info) as src:
+                        data = src.read()
+                    extracted_count += 1
+                    yield os.path.basename(info.filename), data
+            self.logger.info(f"Read {extracted_count} valid document files")
         except Exception as e:
-            self.logger.error(f"Error extracting zip file: {str(e)}")
+            self.logger.error(f"Error reading zip file: {str(e)}")
             raise
-        return extracted_files
 
-    def extract_document_content(self, file_path: str) -> Dict[str, Any]:
+    def _duplicate_candidates(self, zip_path: str) -> set:
+        """
+        (CRC-32, size) pairs shared by more than one valid ZIP member, read from the central
+        directory without decompressing anything. Only these members can be duplicates.
+        """
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            counts = Counter(
+                (info.CRC, info.file_size) for info in zip_ref.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(VALID_EXT)
+            )
+        return {key for key, count in counts.items() if count > 1}
+
+    def _unique_entries(self, entries: Iterator[Tuple[str, bytes]], candidates: set,
+                        copies: Dict[int, List[str]]) -> Iterator[Tuple[str, bytes]]:
+        """
+        Yield only the first of any byte-identical ZIP entries. The names of later copies are
+        collected in copies, keyed by the position of the first copy among the yielded entries.
+        """
+        first_positions = {}  # BLAKE2b digest -> position of the first copy
+        position = 0
+        for file_name, data in entries:
+            if (zlib.crc32(data), len(data)) in candidates:
+                digest = hashlib.blake2b(data, digest_size=16).digest()
+                first_position = first_positions.get(digest)
+                if first_position is not None:
+                    self.logger.info(f"Skipping {file_name}: identical to an earlier document")
+                    copies[first_position].append(file_name)
+                    continue
+                first_positions[digest] = position
+                copies[position] = []
+            yield file_name, data
+            position += 1
+
+    def extract_document_content(self, file_name: str, data: bytes) -> Dict[str, Any]:
+        temp_path = None
         try:
-            self.logger.info(f"Extracting content from {file_path}")
-            os.environ["VISION_KEY"] = self.azure_key
-            os.environ["VISION_ENDPOINT"] = self.azure_endpoint
-            azure_extractor = AzureDocumentIntelligence(file_path=file_path)
+            self.logger.info(f"Extracting content from {file_name}")
+            # The Azure extractor reads from a path, so spill only this document to disk
+            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file_name)[1]) as temp_file:
+                temp_file.write(data)
+                temp_path = temp_file.name
+            azure_extractor = AzureDocumentIntelligence(
+                file_path=temp_path,
+                key=self.azure_key,
+                endpoint=self.azure_endpoint,
+                session=self._session
+            )
             text_content = azure_extractor.extract_text()
             return {
                 'text': text_content,
-                'tables': [],
-                'file_name': os.path.basename(file_path)
+                'file_name': file_name
             }
         except Exception as e:
-            self.logger.error(f"Error extracting content from {file_path}: {str(e)}")
+            self.logger.error(f"Error extracting content from {file_name}: {str(e)}")
             raise
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def _build_records(self, file_name: str, extracted_data: Dict[str, Any]) -> List[InvoiceRow]:
+        # Values are kept as the LLM returned them; the writer's object dtype stops pandas
+        # reformatting numbers (2 stays 2, not 2.0) and its na_rep writes nulls as N/A
+        invoice_info = (file_name, *(extracted_data.get(key, 'N/A') for key in _INVOICE_KEYS))
+
+        items = extracted_data.get('items', [])
+        if not items:
+            return [InvoiceRow(*invoice_info)]
+        return [
+            InvoiceRow(*invoice_info, *(item.get(key, 'N/A') for key in _ITEM_KEYS))
+            for item in items if isinstance(item, dict)
+        ]
 
-    def process_with_pezzo(self, extracted_content: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def _cache_key(self, extracted_content: Dict[str, Any]) -> str:
+        text_hash = hashlib.blake2b(extracted_content['text'].encode(), digest_size=16).hexdigest()
+        return f"{self._prompt_version}:{text_hash}"
+
+    def _cached_extraction(self, extracted_content: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if self._response_cache is None:
+            return None
+        extracted_data = self._response_cache.get(self._cache_key(extracted_content))
+        if extracted_data is not None:
+            self.logger.info(f"Using cached extraction for {extracted_content['file_name']}")
+        return extracted_data
+
+    def _store_extraction(self, extracted_content: Dict[str, Any], extracted_data: Dict[str, Any]):
+        if self._response_cache is not None and isinstance(extracted_data, dict):
+            self._response_cache.set(self._cache_key(extracted_content), extracted_data)
+
+    def _invoke_extraction(self, extracted_content: Dict[str, Any]) -> Dict[str, Any]:
+        # Format the content
+        document_content = self._doc_template.format(text=extracted_content['text'])
+
+        # Render the cached prompt
+        rendered_prompt = self._prompt_template.format(document_content=document_content)
+
+        # Call the LLM
+        llm = self._get_llm()
+        response = llm.invoke(rendered_prompt)
+
+        json_match = _JSON_RE.search(response.content)
+        if not json_match:
+            raise json.JSONDecodeError("No JSON object found in response", response.content, 0)
+        extracted_data = orjson.loads(json_match.group(0))
+        self._store_extraction(extracted_content, extracted_data)
+        return extracted_data
+
+    def _invoke_batch_extraction(self, contents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        document_content = "\n\n".join(
+            f"=== DOC {i} ({content['file_name']}) ===\n{content['text']}"
+            for i, content in enumerate(contents, start=1)
+        )
+        rendered_prompt = self._batch_prompt_template.format(document_content=document_content)
+
+        llm = self._get_llm()
+        response = llm.invoke(rendered_prompt)
+
+        # The whole reply must be the array: searching inside it could pick up an
+        # invoice's items list when the model answers with a single object
+        response_text = response.content.strip()
+        fence_match = _JSON_FENCE_RE.match(response_text)
+        if fence_match:
+            response_text = fence_match.group(1)
+        extracted_batch = orjson.loads(response_text)
+        if not isinstance(extracted_batch, list) or not all(isinstance(item, dict) for item in extracted_batch):
+            raise ValueError("Batch response is not a JSON array of objects")
+        if len(extracted_batch) != len(contents):
+            raise ValueError(f"Expected {len(contents)} documents in batch response, got {len(extracted_batch)}")
+
+        for content, extracted_data in zip(contents, extracted_batch):
+            self._store_extraction(content, extracted_data)
+        return extracted_batch
+
+    def process_with_pezzo(self, extracted_content: Dict[str, Any]) -> List[InvoiceRow]:
         try:
             self.logger.info(f"Processing content with Pezzo for {extracted_content['file_name']}")
 
-            # Format the content
-            document_content = f"""
-            Text from the document:
-            {extracted_content['text']}
-
-            Tables from the document:
-            {json.dumps(extracted_content['tables'], indent=2)}
-            """
-
-            # Get and render the prompt
-            prompt_template = self.pezzo_renderer.get_prompt("ExtractionPrompt")
-            rendered_prompt = prompt_template.format(document_content=document_content)
-
-            # Call the LLM
-            model_deployment = os.getenv('AZURE_MODEL_DEPLOYMENT_NAME')
-            if not model_deployment:
-                raise ValueError("AZURE_MODEL_DEPLOYMENT_NAME environment variable is not set")
-            llm = self.openai_connector.connect_azure_open_ai(model_deployment)
-            response = llm.invoke(rendered_prompt)
-
-            response_text = response.content.strip()
-            if response_text.startswith('```json'):
-                response_text = response_text[len('```json'):].strip()
-            if response_text.endswith('```'):
-                response_text = response_text[:-len('```')].strip()
-
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            if json_start >= 0 and json_end > json_start:
-                json_str = response_text[json_start:json_end]
-                extracted_data = json.loads(json_str)
-            else:
-                raise json.JSONDecodeError("No JSON object found in response", response_text, 0)
-
-            invoice_info = {
-                'source_file': extracted_content['file_name'],
-                'invoice_number': str(extracted_data.get('invoice_number', 'N/A')),
-                'invoice_date': str(extracted_data.get('invoice_date', 'N/A')),
-                'customer_name': str(extracted_data.get('customer_name', 'N/A')),
-                'customer_address': str(extracted_data.get('customer_address', 'N/A'))
-            }
+            extracted_data = self._cached_extraction(extracted_content)
+            if extracted_data is None:
+                extracted_data = self._invoke_extraction(extracted_content)
 
-            items = extracted_data.get('items', [])
-            processed_records = []
-
-            if not items:
-                record = invoice_info.copy()
-                record.update({
-                    'item_description': 'N/A',
-                    'qty': 'N/A',
-                })
-                processed_records.append(record)
-            else:
-                for item in items:
-                    if isinstance(item, dict):
-                        record = invoice_info.copy()
-                        record.update({
-                            'item_description': str(item.get('item_description', 'N/A')),
-                            'qty': str(item.get('qty', 'N/A')),
-                        })
-                        processed_records.append(record)
-            return processed_records
+            return self._build_records(extracted_content['file_name'], extracted_data)
         except Exception as e:
             self.logger.error(f"Error processing with Pezzo: {str(e)}")
             raise
 
-    def process_zip_file(self, zip_path: str) -> str:
+    def process_with_pezzo_batch(self, contents: List[Dict[str, Any]]) -> List[List[InvoiceRow]]:
+        """
+        Extract several documents with a single LLM call. The batch prompt asks for a JSON
+        array with one object per document, in order; returns the records for each document.
+        Documents already in the response cache are left out of the call.
+        """
         try:
-            self.logger.info(f"Starting processing of zip file: {zip_path}")
-            
-            # Extract files from zip
-            extracted_files = self.extract_zip_files(zip_path)
-            if not extracted_files:
-                raise Exception("No valid document files found in the zip archive")
+            file_names = [content['file_name'] for content in contents]
+            self.logger.info(f"Processing batch of {len(contents)} documents with Pezzo: {file_names}")
+
+            extracted_batch = [self._cached_extraction(content) for content in contents]
+            misses = [i for i, extracted_data in enumerate(extracted_batch) if extracted_data is None]
+            if len(misses) == 1:
+                extracted_batch[misses[0]] = self._invoke_extraction(contents[misses[0]])
+            elif misses:
+                fresh = self._invoke_batch_extraction([contents[i] for i in misses])
+                for i, extracted_data in zip(misses, fresh):
+                    extracted_batch[i] = extracted_data
+
+            return [
+                self._build_records(content['file_name'], extracted_data)
+                for content, extracted_data in zip(contents, extracted_batch)
+            ]
+        except Exception as e:
+            self.logger.error(f"Error processing batch with Pezzo: {str(e)}")
+            raise
 
-            self.logger.info(f"Found {len(extracted_files)} files to process")
+    def _error_records(self, file_name: str, error: str) -> List[InvoiceRow]:
+        return [InvoiceRow(file_name, processing_error=error)]
 
-            # Get fieldnames for CSV
-            fieldnames = self.get_csv_fieldnames()
-            
-            # Create output buffer
-            output = StringIO()
-            writer = csv.DictWriter(output, fieldnames=fieldnames)
-            writer.writeheader()
+    def _structure_document(self, content: Dict[str, Any]) -> Tuple[str, bool, List[InvoiceRow]]:
+        """
+        Structure one extracted document with the LLM, returning error records on failure.
+        """
+        try:
+            records = self.process_with_pezzo(content)
+            self.logger.info(f"Successfully processed {content['file_name']} - {len(records)} records")
+            return content['file_name'], False, records
+        except Exception as e:
+            self.logger.error(f"Error processing file {content['file_name']}: {str(e)}")
+            self.logger.error(f"Full traceback: {traceback.format_exc()}")
+            return content['file_name'], True, self._error_records(content['file_name'], str(e))
+
+    def _process_batch(self, contents: List[Dict[str, Any]]) -> List[Tuple[str, bool, List[InvoiceRow]]]:
+        """
+        Structure a batch of extracted documents with one LLM call. Runs on a worker thread, so
+        failures are returned as error records instead of being raised, with a per-file error flag.
+        """
+        if len(contents) == 1:
+            return [self._structure_document(contents[0])]
+        try:
+            batch_records = self.process_with_pezzo_batch(contents)
+        except Exception as e:
+            self.logger.error(f"Error processing files {[c['file_name'] for c in contents]}: {str(e)}")
+            self.logger.error(f"Full traceback: {traceback.format_exc()}")
+            # Retry each document of the failed batch on its own
+            self.logger.info(f"Retrying {len(contents)} documents individually")
+            return [self._structure_document(content) for content in contents]
+
+        results = []
+        for content, records in zip(contents, batch_records):
+            self.logger.info(f"Successfully processed {content['file_name']} - {len(records)} records")
+            results.append((content['file_name'], False, records))
+        return results
+
+    def _iter_results(self, executor: ThreadPoolExecutor, entries: Iterator[Tuple[str, bytes]],
+                      max_in_flight: int) -> Iterator[Tuple[int, Tuple[str, bool, List[InvoiceRow]]]]:
+        """
+        Run Azure Document Intelligence on each ZIP entry as its own task, group the extracted
+        texts into LLM batches of batch_size, and yield per-file results paired with the entry's
+        position as they complete. At most max_in_flight extractions are queued at once.
+        """
+        entries = enumerate(entries)
+        extracting = {}  # future -> (position, file name)
+        structuring = {}  # future -> positions of the batch's documents
+        ready = []  # (position, extracted content) waiting to fill an LLM batch
+        exhausted = False
+        while True:
+            while not exhausted and len(extracting) < max_in_flight:
+                entry = next(entries, None)
+                if entry is None:
+                    exhausted = True
+                    break
+                position, (file_name, data) = entry
+                self.logger.info(f"Worker processing file: {file_name}")
+                future = executor.submit(self.extract_document_content, file_name, data)
+                extracting[future] = (position, file_name)
+
+            # Send full batches, and the remainder once no more texts can arrive
+            while len(ready) >= self.batch_size or (ready and exhausted and not extracting):
+                batch, ready = ready[:self.batch_size], ready[self.batch_size:]
+                future = executor.submit(self._process_batch, [content for _, content in batch])
+                structuring[future] = [position for position, _ in batch]
+
+            if not extracting and not structuring:
+                return
+
+            done, _ = wait([*extracting, *structuring], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in structuring:
+                    yield from zip(structuring.pop(future), future.result())
+                    continue
+                position, file_name = extracting.pop(future)
+                try:
+                    ready.append((position, future.result()))
+                except Exception as e:
+                    self.logger.error(f"Error processing file {file_name}: {str(e)}")
+                    # Return error record to ensure file is not missed
+                    yield position, (file_name, True, self._error_records(file_name, str(e)))
+
+    def _write_zip_csv(self, zip_path: str, output: TextIO):
+        """
+        Process every document in the ZIP and write the resulting CSV rows to output.
+        """
+        # Get fieldnames for CSV
+        fieldnames = self.get_csv_fieldnames()
+
+        # Rows are already positional InvoiceRow tuples; they are encoded by pandas in
+        # chunks, so at most _CSV_CHUNK_ROWS rows are held before writing
+        pd.DataFrame(columns=fieldnames).to_csv(output, index=False)
+        pending_rows = []
+
+        def flush_rows():
+            if pending_rows:
+                # object dtype keeps each value as the LLM returned it (no int -> float
+                # reformatting, identical across chunks); nulls are written as N/A
+                pd.DataFrame(pending_rows, columns=fieldnames, dtype=object).to_csv(
+                    output, header=False, index=False, na_rep='N/A'
+                )
+                pending_rows.clear()
+
+        # Work is network-bound (Azure DI + Azure OpenAI), so size the pool for the services'
+        # rate limits rather than CPU count; 429s are retried with backoff by the clients
+        num_workers = max(1, int(os.getenv('INVOICE_WORKERS', '32')))
+        self.logger.info(f"Using {num_workers} worker threads for parallel processing")
+
+        # Process files in parallel
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                self.logger.info("Starting parallel processing of ZIP entries")
+                # Stream entries from the ZIP straight into the pool, sending byte-identical
+                # documents only once; records are kept only for documents that have copies
+                copies = {}
+                held = {}
+                entries = self._unique_entries(
+                    self.extract_zip_files(zip_path), self._duplicate_candidates(zip_path), copies
+                )
+                results = self._iter_results(executor, entries, num_workers * 2)
+
+                def copy_results():
+                    # Only pulled once every entry has been read, so copies is complete
+                    for position, copy_names in copies.items():
+                        has_error, file_results = held.pop(position)
+                        for copy_name in copy_names:
+                            yield None, (copy_name, has_error,
+                                         [record._replace(source_file=copy_name) for record in file_results])
+
+                # Process results and write to CSV (the buffer is only touched from this thread)
+                total_files = 0
+                total_records = 0
+                files_processed = 0
+                files_with_errors = 0
+
+                for position, (file_name, has_error, file_results) in chain(results, copy_results()):
+                    total_files += 1
+                    if position in copies:
+                        held[position] = (has_error, file_results)
+                    if file_results:  # Ensure we have results
+                        files_processed += 1
+                        if has_error:
+                            files_with_errors += 1
+                        
+                        # Write all records for this file
+                        pending_rows.extend(file_results)
+                        total_records += len(file_results)
+                    else:
+                        # Handle case where no records were produced for the file
+                        self.logger.warning(f"No results returned for file {file_name}")
+                        files_with_errors += 1
+                        # Write error record
+                        pending_rows.extend(self._error_records(file_name, 'No results returned from worker'))
+                        total_records += 1
+
+                    if len(pending_rows) >= _CSV_CHUNK_ROWS:
+                        flush_rows()
+
+                flush_rows()
+
+                self.logger.info(f"Processing summary:")
+                self.logger.info(f"  - Total files found: {total_files}")
+                self.logger.info(f"  - Files processed: {files_processed}")
+                self.logger.info(f"  - Files with errors: {files_with_errors}")
+                self.logger.info(f"  - Total records generated: {total_records}")
 
-            # Determine number of processes (use 75% of available CPUs, but at least 1)
-            num_processes = max(1, int(cpu_count() * 0.75))
-            self.logger.info(f"Using {num_processes} processes for parallel processing")
+        except Exception as e:
+            self.logger.error(f"Error in parallel processing: {str(e)}")
+            self.logger.error(f"Traceback: {traceback.format_exc()}")
+            raise
 
-            # Prepare arguments for worker processes
-            worker_args = [(file_path, self._credentials) for file_path in extracted_files]
+        if not total_files:
+            raise Exception("No valid document files found in the zip archive")
 
-            # Process files in parallel
-            try:
-                with Pool(processes=num_processes) as pool:
-                    self.logger.info(f"Starting parallel processing of {len(worker_args)} files")
-                    
-                    # Use map to process all files
-                    results = pool.map(process_single_file_worker, worker_args)
-                    
-                    self.logger.info(f"Parallel processing completed. Got {len(results)} results")
-                    
-                    # Process results and write to CSV
-                    total_records = 0
-                    files_processed = 0
-                    files_with_errors = 0
-                    
-                    for i, file_results in enumerate(results):
-                        if file_results:  # Ensure we have results
-                            files_processed += 1
-                            
-                            # Check if this file had processing errors
-                            has_error = any('processing_error' in record and record['processing_error'] != 'N/A' 
-                                           for record in file_results if isinstance(record, dict))
-                            if has_error:
-                                files_with_errors += 1
-                            
-                            # Write all records for this file
-                            for record in file_results:
-                                if isinstance(record, dict):
-                                    row_data = {field: record.get(field, 'N/A') for field in fieldnames}
-                                    writer.writerow(row_data)
-                                    total_records += 1
-                        else:
-                            # Handle case where worker returned None or empty list
-                            self.logger.warning(f"No results returned for file index {i}")
-                            files_with_errors += 1
-                            # Write error record
-                            error_record = {
-                                'source_file': f'unknown_file_{i}',
-                                'processing_error': 'No results returned from worker',
-                                **{field: 'N/A' for field in fieldnames if field not in ['source_file', 'processing_error']}
-                            }
-                            writer.writerow(error_record)
-                            total_records += 1
-
-                    self.logger.info(f"Processing summary:")
-                    self.logger.info(f"  - Total files found: {len(extracted_files)}")
-                    self.logger.info(f"  - Files processed: {files_processed}")
-                    self.logger.info(f"  - Files with errors: {files_with_errors}")
-                    self.logger.info(f"  - Total records generated: {total_records}")
+    def process_zip_file(self, zip_path: str, out_path: Optional[str] = None) -> str:
+        """
+        Process a ZIP of invoices into CSV. With out_path the CSV is streamed to that file
+        through a 1 MiB buffer and out_path is returned; otherwise the whole CSV is held in
+        memory and returned as a string, which grows with the size of the archive.
+        """
+        try:
+            self.logger.info(f"Starting processing of zip file: {zip_path}")
 
-            except Exception as e:
-                self.logger.error(f"Error in parallel processing: {str(e)}")
-                self.logger.error(f"Traceback: {traceback.format_exc()}")
-                raise
+            if out_path:
+                try:
+                    with open(out_path, 'w', newline='', encoding='utf-8', buffering=1 << 20) as output:
+                        self._write_zip_csv(zip_path, output)
+                except Exception:
+                    # Don't leave a partial or header-only CSV behind
+                    if os.path.exists(out_path):
+                        os.unlink(out_path)
+                    raise
+                self.logger.info(f"Wrote CSV to {out_path}")
+                return out_path
+
+            output = StringIO()
+            self._write_zip_csv(zip_path, output)
 
             csv_content = output.getvalue()
             self.logger.info(f"Generated CSV with {len(csv_content.split(chr(10))) - 1} total rows")
@@ -358,31 +567,19 @@ class InvoiceProcessor:
             raise
 
     def get_csv_fieldnames(self) -> List[str]:
-        return [
-            'source_file',
-            'invoice_number',
-            'invoice_date',
-            'customer_name',
-            'customer_address',
-            'item_description',
-            'qty',
-            'processing_error'
-        ]
+        return list(InvoiceRow._fields)
 
     def convert_to_csv(self, data: List[Dict[str, Any]]) -> str:
         if not data:
             self.logger.warning("No data to convert to CSV")
             return "No data to convert"
+        records = [record for record in data if isinstance(record, dict)]
         all_keys = set()
-        for record in data:
-            if isinstance(record, dict):
-                all_keys.update(record.keys())
+        for record in records:
+            all_keys.update(record.keys())
         output = StringIO()
-        writer = csv.DictWriter(output, fieldnames=sorted(all_keys))
-        writer.writeheader()
-        for record in data:
-            clean_record = {k: (v if v is not None else "N/A") for k, v in record.items()}
-            writer.writerow(clean_record)
+        df = pd.DataFrame(records, dtype=object).reindex(columns=sorted(all_keys)).fillna("N/A")
+        df.to_csv(output, index=False)
         return output.getvalue()
 
 def create_processor():